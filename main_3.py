@@ -1,15 +1,44 @@
 import re
+import time
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import gspread
 from io import BytesIO
+from gspread.utils import absolute_range_name, fill_gaps
 from oauth2client.service_account import ServiceAccountCredentials
+from requests.adapters import HTTPAdapter
 from concurrent.futures import ThreadPoolExecutor
 
+# --- Регулярные выражения (компилируются один раз при импорте) ---
+# Либо ID после /d/ в ссылке, либо вся строка целиком является ID
+_SHEET_ID_RE = re.compile(r"/d/(?P<url>[a-zA-Z0-9_-]+)|\A(?P<bare>[a-zA-Z0-9_-]+)\Z")
+_TRANS_TABLE = str.maketrans({'х': 'x', '–': '-', '—': '-', 'ё': 'е'})
+_UNIT_RE = re.compile(r'(мм|см|м)\^?2')
+_NORM_SPACE_UNIT = re.compile(r'(?<=\d)\s+(?=мм²|см²|м²)')
+_SIZE_RE = re.compile(r'(\d+(?:[.,]\d+)?)\s*[xх×*]\s*(\d+(?:[.,]\d+)?)')
+_UNIT_POW_RE = re.compile(r'\b(мм|см|м)\s*\^?\s*2\b')
+_TOKEN_RE = re.compile(r'\d+(?:[.,]\d+)?x\d+(?:[.,]\d+)?|мм²|см²|м²|\w+')
+
+# str.strip поэлементно по object-массиву — цикл идёт в numpy, без вложенных списков Python
+_STRIP_CELLS = np.frompyfunc(str.strip, 1, 1)
+
 # --- Конфигурация через Streamlit Secrets ---
 class AppConfig:
     PAGE_TITLE = "🔍 Поиск по Google Таблице"
     PAGE_LAYOUT = "wide"
+    SCOPES = [
+        "https://spreadsheets.google.com/feeds",
+        "https://www.googleapis.com/auth/drive"
+    ]
+    HTTP_POOL_SIZE = 16
+    API_RETRIES = 5
+    SHEETS_PER_BATCH = 10
+    FETCH_WORKERS = 8
+    EXCEL_EAGER_ROWS = 5000
+    CATEGORY_RATIO = 0.05
     
     @staticmethod
     def get_credentials():
@@ -41,89 +70,255 @@ class AppConfig:
 class GoogleSheetsConnector:
     @staticmethod
     @st.cache_resource
-    def get_client():
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(
+    def get_service_credentials():
+        return ServiceAccountCredentials.from_json_keyfile_dict(
             AppConfig.get_credentials(),
-            [
-                "https://spreadsheets.google.com/feeds",
-                "https://www.googleapis.com/auth/drive"
-            ]
+            AppConfig.SCOPES
         )
-        return gspread.authorize(creds)
 
     @staticmethod
-    def extract_sheet_id(url):
-        patterns = [
-            r"/d/([a-zA-Z0-9-_]+)",
-            r"spreadsheets/d/([a-zA-Z0-9-_]+)",
-            r"^([a-zA-Z0-9-_]+)$"
+    @st.cache_resource
+    def get_client():
+        client = gspread.authorize(GoogleSheetsConnector.get_service_credentials())
+        # Клиент общий для всех сессий: расширяем пул соединений, чтобы не переоткрывать TCP/TLS
+        adapter = HTTPAdapter(
+            pool_connections=AppConfig.HTTP_POOL_SIZE,
+            pool_maxsize=AppConfig.HTTP_POOL_SIZE
+        )
+        client.http_client.session.mount("https://", adapter)
+        return client
+
+    @staticmethod
+    def call_with_backoff(request, *args, **kwargs):
+        # Повтор с экспоненциальной задержкой при превышении квоты Google API (HTTP 429)
+        for attempt in range(AppConfig.API_RETRIES):
+            try:
+                return request(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                if e.code != 429 or attempt == AppConfig.API_RETRIES - 1:
+                    raise
+                time.sleep(2 ** attempt)
+
+    @staticmethod
+    @st.cache_data(ttl=300, show_spinner=False)
+    def list_spreadsheets():
+        return [
+            {
+                'title': sheet.title,
+                'url': f"https://docs.google.com/spreadsheets/d/{sheet.id}",
+                'id': sheet.id
+            }
+            for sheet in GoogleSheetsConnector.get_client().openall()
         ]
-        for pattern in patterns:
-            match = re.search(pattern, url)
-            if match:
-                return match.group(1)
-        return None
+
+    @staticmethod
+    @st.cache_data(ttl=300, show_spinner=False)
+    def list_worksheets(sheet_id):
+        # Любая ошибка — пустой список, чтобы она кэшировалась и не шла в API на каждом перезапуске
+        try:
+            spreadsheet = GoogleSheetsConnector.get_client().open_by_key(sheet_id)
+            return [ws.title for ws in spreadsheet.worksheets()]
+        except Exception:
+            # Нет доступа или неверный ID — ошибку покажет load_data при загрузке
+            return []
+
+    @staticmethod
+    def get_revision(sheet_id):
+        # modifiedTime из Drive API — один лёгкий запрос без данных листов.
+        # Если Drive недоступен, ключом остаётся только sheet_id, как раньше
+        try:
+            metadata = GoogleSheetsConnector.call_with_backoff(
+                GoogleSheetsConnector.get_client().get_file_drive_metadata, sheet_id
+            )
+        except gspread.exceptions.APIError:
+            return None
+        return metadata.get('modifiedTime')
+
+    @staticmethod
+    def extract_sheet_id(url):
+        match = _SHEET_ID_RE.search(url)
+        return (match.group('url') or match.group('bare')) if match else None
 
 # --- Обработка данных ---
 class DataProcessor:
     @staticmethod
-    def load_worksheet(ws):
+    def parse_worksheet(title, data):
+        # Проверенные и очищенные строки листа: (название, заголовок, строки) или None
         try:
-            data = ws.get_all_values()
             if not data or len(data) < 2:
                 return None
-            df = pd.DataFrame(data[1:], columns=data[0])
-            df['Лист'] = ws.title
-            for col in df.columns:
-                df[col] = df[col].astype(str).str.strip()
-            return df
+            # Заголовки чистим так же, как значения: ' Цена ' и 'Цена' — одна колонка
+            header = [name.strip() for name in data[0]]
+            if len(set(header)) != len(header):
+                raise ValueError("повторяющиеся названия колонок")
+            # Sheets API отдаёт отформатированные значения строками — чистим их
+            # одним проходом по двумерному object-массиву, до построения DataFrame.
+            # Массив сразу годится и для DataFrame, и для копирования срезом в combine_worksheets
+            cells = np.array(data[1:], dtype=object)
+            if cells.ndim != 2 or cells.shape[1] != len(header):
+                raise ValueError("число значений в строках не совпадает с заголовком")
+            rows = _STRIP_CELLS(cells, out=cells)
+            return title.strip(), header, rows
         except Exception as e:
-            st.error(f"Ошибка загрузки листа '{ws.title}': {e}")
+            st.error(f"Ошибка загрузки листа '{title}': {e}")
             return None
+
+    @staticmethod
+    def combine_worksheets(parsed_sheets):
+        header = parsed_sheets[0][1]
+        if 'Лист' in header or any(sheet_header != header for _, sheet_header, _ in parsed_sheets):
+            # Заголовки различаются — concat выравнивает колонки по именам
+            dfs = []
+            for sheet_title, sheet_header, rows in parsed_sheets:
+                df = pd.DataFrame(rows, columns=sheet_header)
+                df['Лист'] = sheet_title
+                dfs.append(df)
+            return pd.concat(dfs, ignore_index=True, copy=False)
+
+        # Одинаковые заголовки (обычный случай): один массив на все листы,
+        # строки копируются в него срезами без промежуточных DataFrame и concat
+        n_cols = len(header)
+        values = np.empty((sum(len(rows) for _, _, rows in parsed_sheets), n_cols + 1), dtype=object)
+        offset = 0
+        for sheet_title, _, rows in parsed_sheets:
+            values[offset:offset + len(rows), :n_cols] = rows
+            values[offset:offset + len(rows), n_cols] = sheet_title
+            offset += len(rows)
+        return pd.DataFrame(values, columns=header + ['Лист'], copy=False)
         
     @staticmethod
     def normalize_text(text):
-        text = str(text).lower()
-        replacements = {
-            'х': 'x', '–': '-', '—': '-', 'ё': 'е',
-            'мм2': 'мм²', 'мм^2': 'мм²',
-            'см2': 'см²', 'см^2': 'см²',
-            'м2': 'м²', 'м^2': 'м²',
-        }
-        for k, v in replacements.items():
-            text = text.replace(k, v)
-        text = re.sub(r'(?<=\d)\s+(?=мм²|см²|м²)', '', text)
+        text = str(text).lower().translate(_TRANS_TABLE)
+        # Проверка подстроки дешевле прохода регулярки: без '2' и '²' менять нечего
+        if '2' in text:
+            text = _UNIT_RE.sub(r'\1²', text)
+        if '²' in text:
+            text = _NORM_SPACE_UNIT.sub('', text)
         return text
 
     @staticmethod
     def split_preserve_sizes(text):
-        text = DataProcessor.normalize_text(text)
-        text = re.sub(
-            r'(\d+(?:[.,]\d+)?)\s*[xх×*]\s*(\d+(?:[.,]\d+)?)',
-            r'\1x\2',
-            text
-        )
-        text = re.sub(r'\bмм\s*[\^]?\s*2\b', 'мм²', text)
-        text = re.sub(r'\bсм\s*[\^]?\s*2\b', 'см²', text)
-        text = re.sub(r'\bм\s*[\^]?\s*2\b', 'м²', text)
-        return re.findall(r'\d+(?:[.,]\d+)?x\d+(?:[.,]\d+)?|мм²|см²|м²|\w+', text)
+        return DataProcessor.split_normalized(DataProcessor.normalize_text(text))
+
+    @staticmethod
+    def split_normalized(text):
+        # Для текста, уже прошедшего normalize_text: повторная нормализация не нужна
+        text = _SIZE_RE.sub(r'\1x\2', text)
+        text = _UNIT_POW_RE.sub(r'\1²', text)
+        # Порядок и повторы токенов не важны — сразу множество для проверок вхождения
+        return frozenset(_TOKEN_RE.findall(text))
+
+    @staticmethod
+    def normalize_series(series):
+        # Пропуски (NaN/NA из листов без этой колонки) ищутся как пустая строка
+        text = series.astype(object).fillna('').astype(str)
+        text = text.str.lower().str.translate(_TRANS_TABLE)
+        text = text.str.replace(_UNIT_RE, r'\1²', regex=True)
+        return text.str.replace(_NORM_SPACE_UNIT, '', regex=True)
+
+    @staticmethod
+    def prepare_series(series):
+        # Векторный аналог split_preserve_sizes для целой колонки, без разбиения на токены
+        text = DataProcessor.normalize_series(series)
+        text = text.str.replace(_SIZE_RE, r'\1x\2', regex=True)
+        return text.str.replace(_UNIT_POW_RE, r'\1²', regex=True)
+
+    @staticmethod
+    def map_unique(series, func):
+        # Векторная функция считается только по различным значениям и раскладывается
+        # обратно по строкам: в прайсах одни и те же названия и единицы повторяются много раз
+        codes, uniques = pd.factorize(series, use_na_sentinel=False)
+        mapped = func(pd.Series(uniques))
+        return pd.Series(mapped.to_numpy().take(codes), index=series.index)
+
+    @staticmethod
+    def find_tokens(prepared):
+        return DataProcessor.map_unique(prepared, lambda values: values.str.findall(_TOKEN_RE))
 
     @staticmethod
     def match_query(row_text, query_words, require_all=False):
+        # query_words можно передать готовым frozenset, собранным один раз на поиск.
+        # Повторы слов запроса не считаются дважды — как в match_query_series
+        query_set = query_words if isinstance(query_words, frozenset) else frozenset(query_words)
         row_words = DataProcessor.split_preserve_sizes(row_text)
-        match_count = sum(1 for word in query_words if word in row_words)
-        return match_count if not require_all or match_count == len(query_words) else 0
+        if require_all:
+            # Проверка подмножества останавливается на первом отсутствующем слове
+            return len(query_set) if query_set <= row_words else 0
+        # Пересечение множеств считается в C, без Python-цикла по словам
+        return len(query_set & row_words)
 
     @staticmethod
-    def extract_price_columns(df):
-        price_cols = [col for col in df.columns if 'актуальн' in col.lower() and 'цена' in col.lower()]
-        if not price_cols:
-            price_cols = [col for col in df.columns if col.lower() == 'цена']
-        return price_cols
-    
+    def build_token_index(token_lists):
+        # Инвертированный индекс в CSR-виде: для кода токена k номера строк лежат
+        # в postings[offsets[k]:offsets[k + 1]], отсортированные и без повторов
+        # Списки токенов один раз перекладываются в ListArray Arrow: смещения и все токены
+        # лежат в непрерывных буферах, а коды токенам даёт dictionary_encode на стороне C++
+        tokens = pa.array(token_lists, type=pa.list_(pa.large_string()))
+        lengths = np.diff(tokens.offsets.to_numpy())
+        encoded = pc.dictionary_encode(tokens.flatten())
+        codes = encoded.indices.to_numpy().astype(np.int64)
+        vocabulary = encoded.dictionary.to_numpy(zero_copy_only=False)
+        vocab_size = max(len(vocabulary), 1)
+        row_ids = np.repeat(np.arange(len(token_lists), dtype=np.int64), lengths)
+        # Ключ «токен, строка»: np.unique убирает повторы и группирует строки по токену
+        pairs = np.unique(codes * len(token_lists) + row_ids)
+        token_codes, postings = np.divmod(pairs, max(len(token_lists), 1))
+        offsets = np.zeros(vocab_size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(token_codes, minlength=vocab_size), out=offsets[1:])
+        return postings, offsets, pd.Index(vocabulary), len(token_lists)
+
+    @staticmethod
+    def match_query_series(token_index, query_words, require_all=False):
+        # Векторный аналог match_query: token_index — результат build_token_index
+        postings, offsets, vocabulary, n_rows = token_index
+        query_codes = vocabulary.get_indexer(list(frozenset(query_words)))
+        match_count = np.zeros(n_rows, dtype=np.int32)
+        if require_all and (query_codes < 0).any():
+            # Слова нет ни в одной строке — совпадений всех слов быть не может
+            return match_count
+        posting_lists = [postings[offsets[code]:offsets[code + 1]] for code in query_codes[query_codes >= 0]]
+        if not posting_lists:
+            return match_count
+        if require_all:
+            # Пересекаем с самого короткого списка и выходим, как только пусто
+            posting_lists.sort(key=len)
+            rows = posting_lists[0]
+            for other in posting_lists[1:]:
+                rows = np.intersect1d(rows, other, assume_unique=True)
+                if not rows.size:
+                    break
+            match_count[rows] = len(posting_lists)
+            return match_count
+        np.add.at(match_count, np.concatenate(posting_lists), 1)
+        return match_count
+
+    @staticmethod
+    def match_substrings_series(row_text, query_words):
+        # Частичное совпадение: слово запроса ищется как подстрока текста из prepare_series
+        match_count = np.zeros(len(row_text), dtype=np.int32)
+        for word in frozenset(query_words):
+            match_count += row_text.str.contains(word, regex=False).to_numpy(dtype=bool)
+        return match_count
+
+    @staticmethod
+    def find_name_column(df):
+        for column in ('Название', 'название'):
+            if column in df.columns:
+                return column
+        return None
+
     @staticmethod
-    def sort_price_columns(price_columns):
-        return price_columns[:1]
+    def extract_price_columns(df):
+        # Один проход по колонкам: первая «актуальная цена» сразу побеждает,
+        # просто «цена» запоминается как запасной вариант
+        fallback = None
+        for col in df.columns:
+            lowered = col.lower()
+            if 'актуальн' in lowered and 'цена' in lowered:
+                return [col]
+            if fallback is None and lowered == 'цена':
+                fallback = col
+        return [fallback] if fallback is not None else []
 
 # --- UI ---
 class UIComponents:
@@ -142,13 +337,45 @@ class UIComponents:
             st.markdown(f"- {name}")
 
     @staticmethod
-    def make_url_clickable(url):
-        if pd.isna(url) or not str(url).strip():
-            return ""
-        url = str(url).strip()
-        if not url.startswith(('http://', 'https://')):
-            url = 'http://' + url
-        return f'<a href="{url}" target="_blank">{url}</a>'
+    def normalize_urls(urls):
+        # LinkColumn не дописывает схему сама, поэтому добавляем http:// где её нет
+        # Через object: в колонке-категории fillna('') упал бы на новой категории
+        urls = urls.astype(object).fillna('').astype(str).str.strip()
+        has_url = urls.ne('')
+        needs_scheme = has_url & ~urls.str.startswith(('http://', 'https://'))
+        return urls.mask(needs_scheme, 'http://' + urls)
+
+    @staticmethod
+    @st.cache_data(max_entries=16, show_spinner=False)
+    def build_excel(export_df):
+        # xlsxwriter нужен только для выгрузки — импортируем при первой сборке файла
+        import xlsxwriter
+
+        excel_buffer = BytesIO()
+        # Пишем построчно сами: pandas пишет по колонкам, а constant_memory
+        # сбрасывает строку на диск сразу после перехода к следующей
+        workbook = xlsxwriter.Workbook(excel_buffer, {'constant_memory': True})
+        worksheet = workbook.add_worksheet('Результаты')
+        header_format = workbook.add_format(
+            {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}
+        )
+        worksheet.write_row(0, 0, list(export_df.columns), header_format)
+
+        # Все значения из таблицы строковые, пустые ячейки не пишем
+        write_string = worksheet.write_string
+        values = export_df.astype(object).where(export_df.notna(), '')
+        for row_idx, row in enumerate(values.itertuples(index=False, name=None), start=1):
+            for col_idx, value in enumerate(row):
+                if value != '':
+                    write_string(row_idx, col_idx, value)
+
+        workbook.close()
+        return excel_buffer.getvalue()
+
+    @staticmethod
+    @st.cache_data(max_entries=16, show_spinner=False)
+    def build_csv(export_df):
+        return export_df.to_csv(index=False).encode('utf-8-sig')
 
     @staticmethod
     def show_results(results, selected_columns):
@@ -168,72 +395,60 @@ class UIComponents:
                 unsafe_allow_html=True
             )
             
-            # Создаем копию для отображения
-            display_df = results.copy().reset_index(drop=True)
-            display_df.index = display_df.index + 2
-            display_df.index.name = "№ строки"
-            
-            if 'URL' in display_df.columns:
-                display_df['URL'] = display_df['URL'].apply(UIComponents.make_url_clickable)
-            
-            # Отображаем таблицу в контейнере с фиксированной высотой и скроллом
+            # Колонки выбираем до всех преобразований — дальше работаем только с ними
             if selected_columns:
-                columns_to_show = [col for col in selected_columns if col in display_df.columns]
-                filtered_df = display_df[columns_to_show]
+                output_columns = [col for col in selected_columns if col in results.columns]
             else:
-                filtered_df = display_df
+                output_columns = list(results.columns)
 
-            # Контейнер с фиксированной высотой и скроллом
-            st.markdown(
-                f"""
-                <div style='
-                    height: 500px;
-                    overflow-y: auto;
-                    border: 1px solid #e1e4e8;
-                    border-radius: 4px;
-                    padding: 10px;
-                    margin-bottom: 20px;
-                '>
-                    {filtered_df.to_html(escape=False, index=True)}
-                </div>
-                """,
-                unsafe_allow_html=True
+            # Без присваивания в выборку: results — срез combined_df, и запись в него
+            # вызвала бы SettingWithCopyWarning. set_axis и assign возвращают новые фреймы
+            display_df = results[output_columns].set_axis(
+                pd.RangeIndex(2, len(results) + 2, name="№ строки")
             )
 
-            # Подготовка данных для экспорта
-            export_df = results.copy().reset_index(drop=True)
-            if selected_columns:
-                export_columns = [col for col in selected_columns if col in export_df.columns]
-                export_df = export_df[export_columns]
+            if 'URL' in display_df.columns:
+                display_df = display_df.assign(URL=UIComponents.normalize_urls(display_df['URL']))
+
+            # st.dataframe передаёт данные через Arrow и рисует только видимые строки
+            st.dataframe(
+                display_df,
+                height=500,
+                use_container_width=True,
+                column_config={'URL': st.column_config.LinkColumn('URL')}
+            )
+
+            # Индекс в файлы не пишется, поэтому экспорт берёт результаты как есть
+            export_df = results[output_columns] if selected_columns else results
             
-            # Кнопки экспорта
+            # Кнопки экспорта. Файлы кэшируются по содержимому export_df,
+            # поэтому перезапуски скрипта с теми же результатами их не пересобирают
             col1, col2 = st.columns(2)
             
             with col1:
-                # Экспорт в Excel
-                excel_buffer = BytesIO()
-                with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                    export_df.to_excel(writer, index=False, sheet_name='Результаты')
-                excel_buffer.seek(0)
-                
-                st.download_button(
-                    label="⬇️ Скачать в Excel",
-                    data=excel_buffer,
-                    file_name="search_results.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+                # Крупный файл собирается только по запросу и только для запрошенного набора колонок
+                export_columns = tuple(export_df.columns)
+                if (len(export_df) <= AppConfig.EXCEL_EAGER_ROWS
+                        or st.session_state.get('excel_requested') == export_columns):
+                    st.download_button(
+                        label="⬇️ Скачать в Excel",
+                        data=UIComponents.build_excel(export_df),
+                        file_name="search_results.xlsx",
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        on_click="ignore"
+                    )
+                elif st.button("📄 Подготовить Excel"):
+                    st.session_state.excel_requested = export_columns
+                    st.rerun()
             
             with col2:
                 # Экспорт в CSV
-                csv_buffer = BytesIO()
-                export_df.to_csv(csv_buffer, index=False, encoding='utf-8-sig')
-                csv_buffer.seek(0)
-                
                 st.download_button(
                     label="⬇️ Скачать в CSV",
-                    data=csv_buffer,
+                    data=UIComponents.build_csv(export_df),
                     file_name="search_results.csv",
-                    mime="text/csv"
+                    mime="text/csv",
+                    on_click="ignore"
                 )
 
 # --- Основное приложение ---
@@ -261,7 +476,13 @@ class GoogleSheetSearchApp:
             'search_triggered': False,
             'search_results': None,
             'sheets_loaded': False,
-            'need_load': False
+            'need_load': False,
+            'text_cache': {},
+            'token_cache': {},
+            'worksheet_titles': None,
+            'sheet_revision': None,
+            'excel_requested': None,
+            'sorted_output_columns': []
         }
         
         for key, value in session_defaults.items():
@@ -294,53 +515,114 @@ class GoogleSheetSearchApp:
     def load_available_sheets(self):
         try:
             with st.spinner("Поиск доступных таблиц..."):
-                sheets = self.client.openall()
+                sheets = GoogleSheetsConnector.list_spreadsheets()
                 if not sheets:
                     st.warning("Не найдено ни одной доступной таблицы")
                     st.session_state.available_sheets = []
                 else:
-                    st.session_state.available_sheets = [
-                        {
-                            'title': sheet.title,
-                            'url': f"https://docs.google.com/spreadsheets/d/{sheet.id}",
-                            'id': sheet.id
-                        }
-                        for sheet in sheets
-                    ]
+                    st.session_state.available_sheets = sheets
                     st.session_state.sheets_loaded = True
         except Exception as e:
             st.error(f"Ошибка при загрузке списка таблиц: {str(e)}")
             st.session_state.available_sheets = []
 
-    def process_sheets(self, spreadsheet):
-        with ThreadPoolExecutor() as executor:
-            dfs = list(executor.map(DataProcessor.load_worksheet, spreadsheet.worksheets()))
-        return [df for df in dfs if df is not None]
+    @staticmethod
+    def process_sheets(spreadsheet, worksheets):
+        # Листы запрашиваются пачками через values:batchGet вместо запроса на каждый лист.
+        # Обычная книга укладывается в одну пачку; большие качаются параллельно, но ограниченно
+        step = AppConfig.SHEETS_PER_BATCH
+        batches = [worksheets[i:i + step] for i in range(0, len(worksheets), step)]
+        all_data = []
+        with ThreadPoolExecutor(max_workers=max(1, min(AppConfig.FETCH_WORKERS, len(batches)))) as executor:
+            responses = executor.map(
+                lambda batch: GoogleSheetsConnector.call_with_backoff(
+                    spreadsheet.values_batch_get, [absolute_range_name(ws.title) for ws in batch]
+                ),
+                batches
+            )
+            # Пачка разбирается сразу по приходу, пока следующие ещё качаются
+            for batch, response in zip(batches, responses):
+                for ws, vr in zip(batch, response.get('valueRanges', [])):
+                    # API обрезает пустые ячейки в конце строк, fill_gaps выравнивает их как get_all_values
+                    parsed = DataProcessor.parse_worksheet(ws.title, fill_gaps(vr.get('values', [])))
+                    if parsed is not None:
+                        all_data.append(parsed)
+        return all_data
+
+    @staticmethod
+    @st.cache_data(persist="disk", max_entries=16, show_spinner=False)
+    def fetch_combined_df(sheet_id, revision, worksheet_titles=None):
+        # revision нужен только для ключа кэша: правка таблицы меняет его, и кэш устаревает сам
+        spreadsheet = GoogleSheetsConnector.call_with_backoff(
+            GoogleSheetsConnector.get_client().open_by_key, sheet_id
+        )
+        # Список листов — отдельный запрос метаданных, поэтому получаем его один раз
+        worksheets = spreadsheet.worksheets()
+        if worksheet_titles is not None:
+            # Невыбранные листы не скачиваются вовсе
+            worksheets = [ws for ws in worksheets if ws.title in worksheet_titles]
+        all_data = GoogleSheetSearchApp.process_sheets(spreadsheet, worksheets)
+        sheet_names = [ws.title for ws in worksheets]
+        if not all_data:
+            return None, sheet_names
+        combined_df = DataProcessor.combine_worksheets(all_data)
+        # Название листа повторяется в каждой строке — храним его кодами категорий,
+        # как и любые колонки, где различных значений меньше CATEGORY_RATIO от числа строк.
+        # Остальные текстовые колонки — в непрерывных буферах Arrow вместо Python-объектов.
+        # Один astype со словарём типов пересобирает фрейм за раз, без вставки по колонке
+        max_categories = AppConfig.CATEGORY_RATIO * len(combined_df)
+        dtypes = {
+            column: 'category'
+            if column == 'Лист' or combined_df[column].nunique(dropna=False) < max_categories
+            else 'string[pyarrow]'
+            for column in combined_df.columns
+        }
+        combined_df = combined_df.astype(dtypes)
+        return combined_df, sheet_names
 
-    def load_data(self, sheet_url):
+    def load_data(self, sheet_url, worksheet_titles=None):
         try:
             sheet_id = GoogleSheetsConnector.extract_sheet_id(sheet_url)
             if not sheet_id:
                 st.error("❌ Некорректная ссылка на Google Таблицу")
                 return False
 
-            if st.session_state.sheet_id != sheet_id or not st.session_state.data_loaded:
+            if (st.session_state.sheet_id != sheet_id
+                    or st.session_state.worksheet_titles != worksheet_titles
+                    or not st.session_state.data_loaded):
                 with st.spinner("Загрузка данных..."):
-                    spreadsheet = self.client.open_by_key(sheet_id)
-                    all_data = self.process_sheets(spreadsheet)
-                    sheet_names = [ws.title for ws in spreadsheet.worksheets()]
+                    revision = GoogleSheetsConnector.get_revision(sheet_id)
+                    combined_df, sheet_names = self.fetch_combined_df(sheet_id, revision, worksheet_titles)
 
-                    if not all_data:
+                    # Ревизия сменилась — удаляем с диска кэш прежней, загруженной в этой сессии
+                    old_revision = st.session_state.sheet_revision
+                    if (st.session_state.sheet_id == sheet_id
+                            and st.session_state.worksheet_titles == worksheet_titles
+                            and old_revision != revision):
+                        self.fetch_combined_df.clear(sheet_id, old_revision, worksheet_titles)
+
+                    if combined_df is None:
                         st.warning("⚠️ В таблице нет данных")
                         return False
 
-                    st.session_state.combined_df = pd.concat(all_data, ignore_index=True)
+                    st.session_state.combined_df = combined_df
                     st.session_state.sheet_id = sheet_id
+                    st.session_state.worksheet_titles = worksheet_titles
+                    st.session_state.sheet_revision = revision
+                    # Токены колонки по умолчанию готовим сразу, остальные — при первом поиске
+                    st.session_state.text_cache = {}
+                    st.session_state.token_cache = {}
+                    name_column = DataProcessor.find_name_column(combined_df)
+                    if name_column:
+                        self.get_row_tokens(name_column)
                     st.session_state.data_loaded = True
                     st.session_state.sheet_names = sheet_names
                     
-                    price_columns = DataProcessor.extract_price_columns(st.session_state.combined_df)
-                    st.session_state.price_columns = DataProcessor.sort_price_columns(price_columns)
+                    st.session_state.price_columns = DataProcessor.extract_price_columns(combined_df)
+                    # Список колонок для вывода сортируется один раз на загрузку, а не на каждый перезапуск
+                    st.session_state.sorted_output_columns = ['Лист'] + sorted(
+                        col for col in combined_df.columns if col != 'Лист'
+                    )
                     
                     st.success(f"✅ Данные успешно загружены. Записей: {len(st.session_state.combined_df)}")
             return True
@@ -353,6 +635,27 @@ class GoogleSheetSearchApp:
             st.error(f"❌ Неожиданная ошибка: {str(e)}")
             return False
 
+    def get_row_text(self, column):
+        # Ключ включает sheet_id, чтобы кэш не пережил смену таблицы
+        cache_key = (st.session_state.sheet_id, column)
+        text_cache = st.session_state.text_cache
+        if cache_key not in text_cache:
+            # Подготовленный текст тоже держим в Arrow: меньше памяти на сессию,
+            # и str.contains частичного поиска идёт по непрерывному буферу
+            text_cache[cache_key] = DataProcessor.map_unique(
+                st.session_state.combined_df[column], DataProcessor.prepare_series
+            ).astype('string[pyarrow]')
+        return text_cache[cache_key]
+
+    def get_row_tokens(self, column):
+        cache_key = (st.session_state.sheet_id, column)
+        token_cache = st.session_state.token_cache
+        if cache_key not in token_cache:
+            token_cache[cache_key] = DataProcessor.build_token_index(
+                DataProcessor.find_tokens(self.get_row_text(column))
+            )
+        return token_cache[cache_key]
+
     def perform_search(self):
         search_query = st.session_state.get('search_query', '')
         if not search_query or not st.session_state.data_loaded or st.session_state.combined_df is None:
@@ -368,16 +671,22 @@ class GoogleSheetSearchApp:
             query_words = DataProcessor.split_preserve_sizes(search_query)
             require_all = exact_match and not partial_match
             
-            search_df = combined_df.copy()
-            search_df['__match_count'] = search_df[selected_column].apply(
-                lambda text: DataProcessor.match_query(text, query_words, require_all=require_all)
-            )
+            if partial_match:
+                match_count = DataProcessor.match_substrings_series(
+                    self.get_row_text(selected_column), query_words
+                )
+            else:
+                match_count = DataProcessor.match_query_series(
+                    self.get_row_tokens(selected_column), query_words, require_all=require_all
+                )
 
-            results = search_df[search_df['__match_count'] > 0].copy()
-            results = results.sort_values(by='__match_count', ascending=False)
-            results = results.drop(columns='__match_count')
+            # Позиции найденных строк в порядке убывания совпадений — одна выборка из combined_df
+            rows = np.flatnonzero(match_count)
+            rows = rows[np.argsort(-match_count[rows], kind='stable')]
+            results = combined_df.iloc[rows]
 
             st.session_state.search_results = results
+            st.session_state.excel_requested = None
             st.rerun()
 
     def show_main_app(self):
@@ -415,22 +724,45 @@ class GoogleSheetSearchApp:
             help="Пример: https://docs.google.com/spreadsheets/d/ID_ТАБЛИЦЫ/edit#gid=ID_ЛИСТА"
         )
 
-        if st.button("Загрузить данные", disabled=not sheet_url):
+        worksheet_titles = None
+        url_sheet_id = GoogleSheetsConnector.extract_sheet_id(sheet_url) if sheet_url else None
+        if url_sheet_id:
+            all_titles = GoogleSheetsConnector.list_worksheets(url_sheet_id)
+            if len(all_titles) > 1:
+                selected_titles = st.multiselect(
+                    "🗂️ Листы для загрузки",
+                    options=all_titles,
+                    default=all_titles,
+                    help="Загружаются только выбранные листы"
+                )
+                # Все листы — тот же ключ кэша, что и у кнопки «Выбрать»
+                if len(selected_titles) < len(all_titles):
+                    worksheet_titles = tuple(selected_titles)
+
+        if st.button("Загрузить данные", disabled=not sheet_url or worksheet_titles == ()):
             st.session_state.need_load = True
             st.session_state.search_results = None
-            if self.load_data(sheet_url):
+            if self.load_data(sheet_url, worksheet_titles):
+                st.rerun()
+
+        if st.session_state.data_loaded and st.button("🔄 Обновить данные"):
+            # Нужна, если Drive не отдал ревизию или правка ещё не дошла до modifiedTime
+            self.fetch_combined_df.clear(
+                st.session_state.sheet_id, st.session_state.sheet_revision, st.session_state.worksheet_titles
+            )
+            st.session_state.data_loaded = False
+            st.session_state.search_results = None
+            if self.load_data(st.session_state.sheet_id, st.session_state.worksheet_titles):
                 st.rerun()
 
         if st.session_state.data_loaded and st.session_state.combined_df is not None:
             combined_df = st.session_state.combined_df
+            name_column = DataProcessor.find_name_column(combined_df)
             
             col1, col2 = st.columns(2)
             with col1:
-                default_index = 0
-                if 'Название' in combined_df.columns:
-                    default_index = list(combined_df.columns).index('Название')
-                elif 'название' in combined_df.columns:
-                    default_index = list(combined_df.columns).index('название')
+                # get_loc ищет по хэш-таблице индекса, без построения списка колонок
+                default_index = combined_df.columns.get_loc(name_column) if name_column else 0
                 
                 selected_column = st.selectbox(
                     "📁 Выберите колонку для поиска",
@@ -444,20 +776,15 @@ class GoogleSheetSearchApp:
                 default_columns = ['Лист']
                 if 'URL' in combined_df.columns:
                     default_columns.append('URL')
-                if 'Название' in combined_df.columns:
-                    default_columns.append('Название')
-                elif 'название' in combined_df.columns:
-                    default_columns.append('название')
+                if name_column:
+                    default_columns.append(name_column)
                 
                 if st.session_state.price_columns:
                     default_columns.append(st.session_state.price_columns[0])
                 
-                all_columns = [col for col in combined_df.columns if col != 'Лист']
-                all_columns = ['Лист'] + sorted(all_columns)
-                
                 selected_columns = st.multiselect(
                     "📋 Выберите колонки для вывода",
-                    options=all_columns,
+                    options=st.session_state.sorted_output_columns,
                     default=default_columns,
                     key="output_columns"
                 )